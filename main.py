@@ -1,4 +1,7 @@
+import codecs
 import re
+import selectors
+import socket
 import sys
 import time
 import typing
@@ -8,21 +11,45 @@ __author__ = "Bojan Potočnik"
 
 import ctypes
 import os
-import telnetlib
+
+# ANSI escape sequences for colored console output.
+_RED = "\x1B[31;1m"  # Bold red
+_GREEN = "\x1B[32;1m"  # Bold/Bright green
+_BLUE = "\x1B[34;1m"  # Bold/Bright blue
+_MAGENTA = "\x1B[35;1m"  # Bold/Bright magenta
+_RESET = "\x1B[0m"
+
+# Information printed by the JLink RTT server when the client connects, matched directly on the received bytes.
+_JLINK_BANNER_RE = re.compile(rb"SEGGER J-Link (V[\w.]+) - Real time terminal output\r?\n"
+                              rb"SEGGER J-Link ([\w .]+), SN=(\d+)\r?\n"
+                              rb"Process: ([\w.\-]+)\r?\n")
+_JLINK_BANNER_START = b"SEGGER J-Link "
 
 
 class SeggerRTTClient:
+    # JLink RTT server streams raw target data over plain TCP - it never sends telnet IAC (0xFF)
+    # command sequences, so no telnet protocol handling is required and plain socket is used.
+
     def __init__(self, host: str = "localhost", port: int = 19021):
-        self.telnet = telnetlib.Telnet(timeout=1)  # type: telnetlib.Telnet
+        # Set first, so that __del__ works even if anything below raises.
+        self._opened = False
+        self._sock: typing.Optional[socket.socket] = None
+        # Used to wait for the received data without periodically polling the socket.
+        self._selector = selectors.DefaultSelector()
+        # Data received from the socket but not yet consumed by any of the read methods.
+        self._rxbuf = bytearray()
+        # Reusable receive buffer, to avoid allocating new bytes object for every received chunk.
+        self._scratch = memoryview(bytearray(4096))
+        # Multi-byte UTF-8 characters can be split between received chunks.
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
         self.host = host
         self.port = port
-        self._opened = False
 
     # noinspection SpellCheckingInspection
     def open(self, parse_jlink_info: bool = True):
         """Connect to the JLink host."""
         try:
-            self.telnet.open(self.host, self.port)
+            self._sock = socket.create_connection((self.host, self.port), timeout=1)
         except ConnectionRefusedError:
             raise ConnectionRefusedError(
                 f"Could not connect to {self.host}:{self.port}."
@@ -30,38 +57,55 @@ class SeggerRTTClient:
                 " You can run it with 'JLink -Device <DEVICE> -If <IF> -AutoConnect 1 -Speed <kHz>'"
                 ", e.g. 'JLink --Device NRF52840_xxAA -If SWD -AutoConnect 1 -Speed 50000'"
             )
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Socket keeps the 1 s timeout (used for writing) - all reads first wait for the data to be available.
+        self._selector.register(self._sock, selectors.EVENT_READ)
+        self._rxbuf.clear()
+        self._decoder.reset()
         self._opened = True
 
-        # Bold/Bright green
-        msg = "\x1B[32;1m" + f"{type(self).__name__} connected to {self.telnet.host}:{self.telnet.port}"
+        msg = [_GREEN, f"{type(self).__name__} connected to {self.host}:{self.port}"]
         if parse_jlink_info:
-            # Wait for JLink information to be printed.
-            # self.telnet.expect() could be used, but it throws error
-            # `TypeError: cannot use a string pattern on a bytes-like object` because it executes
-            # `m = list[i].search(self.cookedq)` where `self.cookedq` is bytes, not str.
-            # Manual matching is done instead.
-            # 3 newline characters are required for RegEx below to match.
-            data = b''.join(self.telnet.read_until(b'\n', 0.1) for _ in range(3))
-            match = re.match(r"SEGGER J-Link (V[\w.]+) - Real time terminal output\r?\n"
-                             r"SEGGER J-Link ([\w .]+), SN=([\d]+)\r?\n"
-                             r"Process: ([\w.\-]+)\r?\n", data.decode('utf-8')) if data else None
+            # Wait for JLink information to be printed, but at most 300 ms in total. It mostly arrives in
+            # a single TCP segment, so waiting is finished as soon as the RegEx matches or cannot match
+            # anymore (other data was received or 3 lines were already received). Unmatched data is
+            # left in the buffer as-is.
+            deadline = time.monotonic() + 0.3
+            while True:
+                match = _JLINK_BANNER_RE.match(self._rxbuf)
+                if match:
+                    break
+                if ((not _JLINK_BANNER_START.startswith(self._rxbuf[:len(_JLINK_BANNER_START)]))
+                        or (self._rxbuf.count(b'\n') >= 3)):
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                received = self._recv(remaining)
+                if received < 0:
+                    raise ConnectionAbortedError(f"Connection to {self.host}:{self.port} was closed"
+                                                 " while waiting for the JLink information.")
+                if received == 0:
+                    break
             if match:
-                data = data[match.span()[1]:]  # Leave only the unused data in the buffer.
-                # Bold/Bright blue
-                msg += "\x1B[34;1m" + f" ('{match[3]}' {match[1]} using {match[2]} (SN {match[3]}))"
-            # Put unrecognized/unused data back in the buffer (in front of any new data received in meantime).
-            self.telnet.cookedq = data + self.telnet.cookedq
-        print(msg + "\x1B[0m", flush=True)
+                version, probe, serial_number, process = (group.decode('ascii') for group in match.groups())
+                del self._rxbuf[:match.end()]
+                msg += (_BLUE, f" ('{process}' {version} using {probe} (SN {serial_number}))")
+        msg.append(_RESET + "\n")
+        sys.stdout.write("".join(msg))
+        sys.stdout.flush()
 
     def close(self):
         """Close the connection, if opened."""
         if self._opened:
-            self.telnet.close()
-            self._opened = False
-            # Bold/Bright magenta
-            print("\x1B[35;1m"
-                  f"Connection to {self.telnet.host}:{self.telnet.port} closed."
-                  "\x1B[0m", flush=True)
+            self._release()
+            print(f"{_MAGENTA}Connection to {self.host}:{self.port} closed.{_RESET}", flush=True)
+
+    def _release(self) -> None:
+        """Release the opened socket without printing anything."""
+        self._selector.unregister(self._sock)
+        self._sock.close()
+        self._opened = False
 
     def __enter__(self):
         self.open()
@@ -70,43 +114,94 @@ class SeggerRTTClient:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
 
+    def _recv(self, timeout: typing.Optional[float]) -> int:
+        """
+        Receive available data (waiting at most `timeout` seconds, or indefinitely if None) and append it to the buffer.
+
+        :return: Number of received bytes, 0 if no data was received or -1 if the connection was lost.
+        """
+        if not self._opened:
+            return -1
+        if not self._selector.select(timeout):
+            return 0
+        try:
+            received = self._sock.recv_into(self._scratch)
+        except socket.timeout:
+            return 0
+        except ConnectionResetError:
+            received = 0
+        if not received:
+            print(f"{_RED}{type(self).__name__} disconnected from {self.host}:{self.port}.{_RESET}", flush=True)
+            self.close()
+            return -1
+        self._rxbuf += self._scratch[:received]
+        return received
+
+    def read_blocking_bytes(self) -> bytes:
+        """Read any available data and return it as raw bytes, or empty bytes if disconnected."""
+        while not self._rxbuf:
+            # Wait at most 1 s at the time so that the closed connection (and Ctrl+C on Windows) is noticed.
+            if self._recv(1.0) < 0:
+                return b''
+        rx_data = bytes(self._rxbuf)
+        self._rxbuf.clear()
+        return rx_data
+
     def read_blocking(self) -> str:
         """Read any available data and return it as-is."""
         while True:
-            try:
-                rx_data = self.telnet.read_very_eager()
-            except ConnectionResetError:
-                # Bold red
-                print("\x1B[31;1m"
-                      f"{type(self).__name__} disconnected from {self.host}:{self.port}."
-                      "\x1B[0m")
-                self.close()
-                return "\x00"
+            while not self._rxbuf:
+                # Wait at most 1 s at the time so that the closed connection (and Ctrl+C on Windows) is noticed.
+                if self._recv(1.0) < 0:
+                    return "\x00"
+            # Incomplete character at the end is kept by the decoder until the rest of it is received.
+            rx_data = self._decoder.decode(self._rxbuf)
+            self._rxbuf.clear()
             if rx_data:
+                return rx_data
+
+    def read_line_bytes(self) -> typing.Optional[bytes]:
+        """Read one line as bytes without the ending newline (\n or \r\n), or None if disconnected."""
+        # Only wait for \n as some code uses \r\n as newline and other only \n.
+        # Data already searched is not searched again when long line is received in multiple chunks.
+        scanned = 0
+        while True:
+            idx = self._rxbuf.find(b'\n', scanned)
+            if idx >= 0:
                 break
-            time.sleep(0.01)
-        try:
-            return rx_data.decode('utf-8')
-        except UnicodeDecodeError as e:
-            print(f"While decoding {rx_data}: {e}", file=sys.stderr)
-            return rx_data.decode('utf-8', errors='replace')
+            if not self.connected:
+                return None
+            scanned = len(self._rxbuf)
+            # Wait at most 1 s at the time so that the closed connection is noticed.
+            self._recv(1.0)
+        # Line cannot contain \n anymore, only the (possible) last \r has to be removed.
+        end = (idx - 1) if (idx and (self._rxbuf[idx - 1] == ord('\r'))) else idx
+        line = bytes(self._rxbuf[:end])
+        del self._rxbuf[:idx + 1]
+        return line
+
+    def read_line(self) -> typing.Optional[str]:
+        """Read one line without the ending newline (\n or \r\n), or return None if disconnected."""
+        line = self.read_line_bytes()
+        return None if line is None else line.decode('utf-8', errors='replace')
+
+    def read_lines_bytes(self) -> typing.Iterator[bytes]:
+        """Read line by line as raw bytes, without the ending newline (\n or \r\n) of each line."""
+        while True:
+            line = self.read_line_bytes()
+            if line is None:
+                return
+            yield line
 
     def read_lines(self) -> typing.Iterator[str]:
-        """Read line by line and strip all newline characters (\r\n) at the end."""
-        while self.connected:
-            # Wait for new line indefinitely, remove newline characters at the end and convert it to string.
-            # Only wait for \n as some code uses \r\n as newline and other only \n.
-            rx_data = ""
-            while "\n" not in rx_data:
-                rx_data += self.read_blocking()
-            # Multiple lines can be received.
-            for line in rx_data.split("\n"):
-                yield line.strip("\r\n")
+        """Read line by line, without the ending newline (\n or \r\n) of each line."""
+        for line in self.read_lines_bytes():
+            yield line.decode('utf-8', errors='replace')
 
     def write_line(self, buffer: typing.Union[bytes, str]) -> None:
         if isinstance(buffer, str):
             buffer = buffer.encode('ascii')
-        self.telnet.write(buffer + b"\n")
+        self._sock.sendall(buffer + b"\n")
 
     def __iter__(self) -> typing.Iterator[str]:
         """Read (undetermined) fragments of received data and return it as-is."""
@@ -114,11 +209,16 @@ class SeggerRTTClient:
             yield self.read_blocking()
 
     def __del__(self):
-        self.close()
+        # Only release the resources - printing is not reliable during the interpreter shutdown.
+        if getattr(self, '_opened', False):
+            self._release()
+        selector = getattr(self, '_selector', None)
+        if selector is not None:
+            selector.close()
 
     @property
     def connected(self) -> bool:
-        return self.telnet.sock and (not self.telnet.eof) and (self.telnet.get_socket().fileno() != -1)
+        return (self._sock is not None) and (self._sock.fileno() != -1)
 
     def __bool__(self) -> bool:
         return self.connected
@@ -154,7 +254,7 @@ def main__open_close() -> None:
     except KeyboardInterrupt:
         print("User requested keyboard interrupt")
     finally:
-        # In this case calling close() is not strictly required as it will be called
+        # In this case calling close() is not strictly required as the connection will be released
         # automatically when the object is garbage collected, however this shall not be
         # relied upon - open()-ed resources shall always be close()-ed.
         client.close()
@@ -162,10 +262,23 @@ def main__open_close() -> None:
 
 def main__context_manager() -> None:
     user_input_sent = False
+    stdout_buffer = getattr(sys.stdout, "buffer", None)
 
     with SeggerRTTClient() as client:
-        for line in client:
-            print(line, end="")
+        if stdout_buffer is not None:
+            # Received data is written to the console as-is, without decoding and re-encoding it.
+            read_data, stdout = client.read_blocking_bytes, stdout_buffer
+        else:
+            # Standard output was replaced by text-only stream (e.g. in some IDE consoles).
+            read_data, stdout = client.read_blocking, sys.stdout
+        while client.connected:
+            data = read_data()
+            if not client.connected:
+                # Disconnected - only the "no data" value was returned, which is not written.
+                break
+            stdout.write(data)
+            # Each fragment is flushed as it may end with a prompt without the newline (e.g. Nordic CLI).
+            stdout.flush()
             if not user_input_sent:  # Sent input only once and continue reading
                 client.write_line(b"\t")  # Tab on Nordic RTT CLI shows available commands
                 user_input_sent = True